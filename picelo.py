@@ -3,23 +3,31 @@
 __description__ = """\
 Elo rating system for image sorting.
 
-Open directory with images and press <Left> or <Right> arrow key to vote for a better image. Images will be presented in random order, each vote renames image according to Elo score. Three matching rounds will be performed.
+Open directory with images and press <Left> or <Right> arrow key to vote for a better image. Images will be presented in random order, each vote updates Elo score. Three matching rounds will be performed. Scores are saved to "picelo.db" in the chosen directory.
 
-After matching, images could be observed in file manager, as they are named alphanumerically.
+After matching, use "Export to filenames" to observe images in file manager, as they will be named alphanumerically. Such names are also imported as initial scores.
 
     "[{elo_score},{total_matches}] filename".jpg
 
 https://www.coorpacademy.com/en/blog/learning-innovation-en/elo-whos-the-best/
 """
 
+import functools
+import itertools
+import os
 import pathlib
-import random
+import sqlite3
 import tkinter as tk
+from concurrent.futures import Future, ThreadPoolExecutor
 from tkinter import filedialog, messagebox, ttk
 
-from PIL import Image, ImageTk
+import numpy as np
+from PIL import Image, ImageTk  # Drop-in `pillow-simd` speeds up resampling
 
 __software_name__ = "Picelo"
+DB_NAME = "picelo.db"
+# Lowercase extensions with leading dot, unsupported formats removed
+_PIL_EXTS = frozenset(e.lower() for e in Image.registered_extensions()) - {".pdf"}
 
 
 class MainWindow(tk.Tk):
@@ -31,9 +39,20 @@ class MainWindow(tk.Tk):
         self.geometry("640x240")
 
         self._fp_list: list = list()
-        # Saves current ranking progress, new iteration on StopIteration
-        self._fp_list_iter = iter(())
+        self._keys: set[str] = set()  # `RankFileModel.key` of `_fp_list`
+        self._store: Store | None = None
+        # Directory is scanned in batches on idle, see `_scan_step`
+        self._scan = iter(())
+        self._scan_after: str | None = None
+        self._scan_done = True
+        # Shuffled `_fp_list` indices, cursor saves current ranking progress
+        self._rng = np.random.default_rng()
+        self._order: np.ndarray = np.arange(0)
+        self._cursor = 0
         self._rounds = 0
+        # Decode upcoming pair while user is looking at the current one
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=2)
+        self._prefetched: dict[str, tuple[tuple[int, int], Future]] = dict()
 
         menubar = tk.Menu(self)  # Conventional name
         self["menu"] = menubar
@@ -42,6 +61,11 @@ class MainWindow(tk.Tk):
         self._menu_file.add_command(
             label="Open directory", command=self.open_directory, accelerator="Ctrl+O"
         )
+        self._menu_file.add_command(
+            label="Export to filenames",
+            command=self.export_names,
+            state=tk.DISABLED,
+        )
         self._menu_file.add_command(
             label="Reset score", command=self.reset_score, state=tk.DISABLED
         )
@@ -61,6 +85,7 @@ class MainWindow(tk.Tk):
             ),
         )
 
+        self.protocol("WM_DELETE_WINDOW", self.destroy)
         self.bind("<Escape>", lambda e: self.destroy())
         self.bind("<Control-o>", self.open_directory)
 
@@ -78,28 +103,93 @@ class MainWindow(tk.Tk):
         img_frame.add(self._img_right, weight=1)
         img_frame.pack(expand=True, fill=tk.BOTH)
 
+    def destroy(self):
+        """Save pending votes before exit."""
+        if self._scan_after is not None:
+            self.after_cancel(self._scan_after)
+            self._scan_after = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+        # Don't wait for decoding, window is gone anyway
+        self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        super().destroy()
+
     def open_directory(self, event=None):
         if pic_dir := filedialog.askdirectory(
             parent=self, mustexist=True, title="Choose directory with pictures"
         ):
-            # Remove unsupported formats
-            pil_file_extensions = Image.registered_extensions().keys() - {".pdf"}
+            pic_dir = os.path.realpath(pic_dir)
+            if self._store is not None:
+                self._store.close()
+            self._store = Store(pic_dir)
 
             # Recursive
-            self._rounds = 0  # Start scoring again
+            _render_cached.cache_clear()
+            _load_pyramid.cache_clear()
+            self._discard_prefetched()
+            self._order = np.arange(0)
+            self._cursor = 0
             self._fp_list = list()
-            for p in pathlib.Path(pic_dir).glob("**/*"):
-                if p.suffix in pil_file_extensions:
-                    self._fp_list.append(RankFileModel(p.resolve()))
+            self._keys = set()
+            self._img_left.unset_image()
+            self._img_right.unset_image()
+
+            # Start scoring again, first round goes along with scanning
+            self._rounds = 1
+            print(f"Round {self._rounds}")
+            if self._scan_after is not None:
+                self.after_cancel(self._scan_after)
+            self._scan = _iter_images(pic_dir)
+            self._scan_done = False
+            self._scan_after = self.after_idle(self._scan_step)
+            # Renaming files while scanning could yield the same file twice
+            self._menu_file.entryconfigure("Export to filenames", state=tk.DISABLED)
+            self._menu_file.entryconfigure("Reset score", state=tk.DISABLED)
+
+    def _scan_step(self, batch: int = 256):
+        """Add next batch of found images, so user could vote without waiting."""
+        self._scan_after = None
+        start = len(self._fp_list)
+        done = True  # Also on error, otherwise next rounds would never start
+        try:
+            scanned = 0
+            for fp in itertools.islice(self._scan, batch):
+                scanned += 1
+                rf = RankFileModel(fp, self._store)
+                if rf.key in self._keys:
+                    # Ratings of both files would be merged into a single row
+                    print(f"Skipped, file with the same name is already rated: {fp}")
+                    continue
+                self._keys.add(rf.key)
+                self._fp_list.append(rf)
+            done = scanned < batch
+        finally:
+            # Mix new images with all not yet shown in current round, except
+            # the next pair, which could be prefetched already
+            self._order = np.concatenate(
+                (self._order, np.arange(start, len(self._fp_list)))
+            )
+            self._rng.shuffle(self._order[self._cursor + 2 :])
+            if done:
+                self._scan_done = True
+                self._menu_file.entryconfigure("Export to filenames", state=tk.NORMAL)
+                self._menu_file.entryconfigure("Reset score", state=tk.NORMAL)
+                # Limit to 3 match rounds
+                # self._fp_list = list(filter(lambda k: k.matches < 3, [RankFileModel(k) for k in self._fp_list]))
+                if not self._fp_list:
+                    messagebox.showerror(message="Images not found")
+                print(f"{len(self._fp_list)} images to sort")
+            else:
+                self._scan_after = self.after_idle(self._scan_step)
 
-            # Limit to 3 match rounds
-            # self._fp_list = list(filter(lambda k: k.matches < 3, [RankFileModel(k) for k in self._fp_list]))
-            if not self._fp_list:
-                messagebox.showerror(message="Images not found")
+            if not self._img_left:  # Waiting for images
+                self.load_next()
 
-            print(f"{len(self._fp_list)} images to sort")
-            self.load_next()
-            self._menu_file.entryconfigure("Reset score", state=tk.NORMAL)
+    def export_names(self):
+        """Rename files according to rating, so it's visible in file manager."""
+        for p in self._fp_list:
+            p.update_name()
 
     def reset_score(self):
         resp = messagebox.askyesno(
@@ -110,6 +200,7 @@ class MainWindow(tk.Tk):
         if resp:
             for p in self._fp_list:
                 p.reset_name()
+            self._store.clear()
 
     def arrow_press(self, event=None):
         if event.keysym == "Left" and self._img_left:
@@ -126,22 +217,173 @@ class MainWindow(tk.Tk):
     def load_next(self):
         """Shuffle images and perform N rounds of matching.
 
-        Use iterator to store position between sequential calls.
+        Use cursor to store position between sequential calls.
         """
-        try:
-            self._img_left.set_image(next(self._fp_list_iter))
-            self._img_right.set_image(next(self._fp_list_iter))
-        except StopIteration:
+        if self._store is None:  # No directory opened
+            return
+        self._store.commit()  # Cheap with WAL and synchronous=NORMAL
+        if self._cursor + 2 <= len(self._order):
+            left = self._fp_list[self._order[self._cursor]]
+            right = self._fp_list[self._order[self._cursor + 1]]
+            self._cursor += 2
+            self._img_left.set_image(left, self._prefetched.pop(left.fp, None))
+            self._img_right.set_image(right, self._prefetched.pop(right.fp, None))
+            self._prefetch()
+        elif not self._scan_done:
+            # Next pair will be shown by `_scan_step`
+            self._img_left.unset_image()
+            self._img_right.unset_image()
+        else:
             if self._rounds < 3:
                 self._rounds += 1
                 print(f"Round {self._rounds}")
-                random.shuffle(self._fp_list)
-                self._fp_list_iter = iter(self._fp_list)
+                self._order = self._rng.permutation(len(self._fp_list))
+                self._cursor = 0
+                self._discard_prefetched()
                 self.load_next()
             else:
                 self._img_left.unset_image()
                 self._img_right.unset_image()
 
+    def _discard_prefetched(self):
+        for _, future in self._prefetched.values():
+            _discard_preview(future)
+        self._prefetched.clear()
+
+    def _prefetch(self):
+        """Decode next pair in background threads.
+
+        Only `PIL.Image` is prepared, as Tk objects must be created in main thread.
+        """
+        upcoming = self._order[self._cursor : self._cursor + 2]
+        for view, i in zip((self._img_left, self._img_right), upcoming):
+            fp = self._fp_list[i].fp
+            size = view.viewport_size()
+            self._prefetched[fp] = (
+                size,
+                self._prefetch_pool.submit(
+                    _decode_and_thumbnail,
+                    fp,
+                    os.stat(fp).st_mtime_ns,
+                    *size,
+                    view.screen_size(),
+                ),
+            )
+
+
+def _discard_preview(future: Future):
+    """Release `_decode_and_thumbnail` result which won't be shown."""
+
+    def close(f: Future):
+        if f.exception() is None:
+            f.result().close()
+
+    if not future.cancel():  # Already decoding
+        future.add_done_callback(close)
+
+
+def _iter_images(root: str):
+    """Find supported images recursively, symlinks and unreadable dirs are skipped.
+
+    `os.scandir` is used instead of `pathlib.Path.glob` to avoid `stat` call
+    and `Path` object creation for each file.
+
+    Args:
+        root: Directory to scan
+    """
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+                    elif e.is_file(follow_symlinks=False):
+                        name = e.name
+                        dot = name.rfind(".")
+                        if dot >= 0 and name[dot:].lower() in _PIL_EXTS:
+                            yield e.path
+        except OSError as e:
+            # Skip unreadable directories, same as `pathlib.Path.glob`
+            print(e)
+
+
+def _fit(size: tuple[int, int], width: int, height: int) -> tuple[int, int]:
+    """Scale image size to viewport, keeping aspect ratio."""
+    if width / height > size[0] / size[1]:  # Height is limiting viewport
+        scale = height / size[1]
+    else:
+        scale = width / size[0]
+    return int(size[0] * scale), int(size[1] * scale)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_pyramid(
+    fp: str, mtime_ns: int, max_size: tuple[int, int]
+) -> tuple[Image.Image, ...]:
+    """Decode image once for any viewport up to `max_size`.
+
+    Args:
+        fp: File path
+        mtime_ns: Modification time, invalidates entry if file has been changed
+        max_size: Biggest viewport, e.g. screen size
+
+    Returns:
+        RGB(A) image at full, 1/2 and 1/4 resolution.
+    """
+    img = Image.open(fp)
+    target = _fit(img.size, *max_size)
+    if img.format == "JPEG":
+        # libjpeg DCT scaling by 1/2, 1/4 or 1/8
+        img.draft("RGB", target)
+    img.load()
+    # Palette images are resized with NEAREST only, CMYK has an extra channel
+    if img.mode not in ("RGB", "RGBA"):
+        rgb = img.convert("RGB")
+        img.close()
+        img = rgb
+    # Don't keep more pixels than screen could show, draft works for JPEG only
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor > 1:
+        reduced = img.reduce(factor)
+        img.close()
+        img = reduced
+    return img, img.reduce(2), img.reduce(4)
+
+
+def _decode_and_thumbnail(
+    fp: str, mtime_ns: int, width: int, height: int, max_size: tuple[int, int]
+) -> Image.Image:
+    """Fit image into viewport.
+
+    Thread-safe, could be used for prefetching.
+
+    Args:
+        fp: File path
+        mtime_ns: Modification time, see `_load_pyramid`
+        width: Viewport width
+        height: Viewport height
+        max_size: Biggest viewport, see `_load_pyramid`
+    """
+    pyramid = _load_pyramid(fp, mtime_ns, max_size)
+    size = _fit(pyramid[0].size, width, height)
+    # Smallest level which is still not less than viewport
+    level = next(
+        (i for i in reversed(pyramid) if i.width >= size[0] and i.height >= size[1]),
+        pyramid[0],
+    )
+    # Integer-factor `reduce()` first, costly resampling only on last pass
+    return level.resize(size, resample=Image.Resampling.BILINEAR, reducing_gap=3.0)
+
+
+@functools.lru_cache(maxsize=64)
+def _render_cached(
+    fp: str, mtime_ns: int, width: int, height: int, max_size: tuple[int, int]
+) -> ImageTk.PhotoImage:
+    """Same as `_decode_and_thumbnail`, but ready for Tk."""
+    with _decode_and_thumbnail(fp, mtime_ns, width, height, max_size) as preview:
+        return ImageTk.PhotoImage(preview)
+
 
 class ImageView(ttk.Frame):
     """Tkinter image viewer.
@@ -152,8 +394,9 @@ class ImageView(ttk.Frame):
     def __init__(self, master=None):
         super().__init__(master)
         self.model: RankFileModel = None
-        self._img: Image | None  # Cached image for resize
-        self._img_tk: ImageTk.PhotoImage  # Keep reference for GC
+        self._img_tk: ImageTk.PhotoImage | None  # Keep reference for GC
+        self._render_after: str | None = None  # Pending redraw, see `_render`
+        self._prefetched: tuple[tuple[int, int], Future] | None = None
         self._lbl = ttk.Label(self, compound=tk.BOTTOM, anchor=tk.CENTER)
         self._lbl.pack(expand=True, fill=tk.BOTH)
         self._lbl.bind("<Configure>", self._render)
@@ -172,32 +415,62 @@ class ImageView(ttk.Frame):
         self.unset_image()
 
     def _render(self, event=None):
+        """Coalesce bursts of <Configure> events while dragging window border."""
+        if self._render_after is not None:
+            self.after_cancel(self._render_after)
+        self._render_after = self.after(30, self._do_render)
+
+    def _do_render(self):
+        self._render_after = None
         if self:
-            # Keep aspect ratio
-            image_ar = self._img.width / self._img.height
-            widget_ar = self._lbl.winfo_width() / self._lbl.winfo_height()
-            if widget_ar > image_ar:  # Height is limiting viewport
-                scale = self._lbl.winfo_height() / self._img.height
+            size = self.viewport_size()
+            # Frees previous image only if it was prefetched, cached ones stay
+            # in `_render_cached` anyway
+            self._img_tk = None
+            if self._prefetched is not None and self._prefetched[0] == size:
+                with self._prefetched[1].result() as preview:
+                    self._img_tk = ImageTk.PhotoImage(preview)
             else:
-                scale = self._lbl.winfo_width() / self._img.width
-
-            preview = self._img.resize(
-                (int(self._img.width * scale), int(self._img.height * scale))
-            )
-            self._img_tk = ImageTk.PhotoImage(preview)
+                if self._prefetched is not None:  # Viewport has been resized
+                    _discard_preview(self._prefetched[1])
+                fp = self.model.fp
+                self._img_tk = _render_cached(
+                    fp, os.stat(fp).st_mtime_ns, *size, self.screen_size()
+                )
+            self._prefetched = None
             self._lbl["image"] = self._img_tk
 
-    def set_image(self, rf):
+    def viewport_size(self) -> tuple[int, int]:
+        """Round viewport down to 16 px, so dragging window border hits cache."""
+        return (
+            max(self._lbl.winfo_width() & ~15, 16),
+            max(self._lbl.winfo_height() & ~15, 16),
+        )
+
+    def screen_size(self) -> tuple[int, int]:
+        """Biggest possible viewport."""
+        return self.winfo_screenwidth(), self.winfo_screenheight()
+
+    def set_image(self, rf, prefetched: tuple[tuple[int, int], Future] | None = None):
+        """Show image.
+
+        Args:
+            rf: Image to show
+            prefetched: Viewport size and `_decode_and_thumbnail` result
+        """
         self.model = rf
         self._lbl["text"] = self.model.filename()
-        self._img = Image.open(self.model.get_fp())
-        self._render()
+        self._prefetched = prefetched
+        self._do_render()
 
     def unset_image(self):
         self.model = None
         self._lbl["text"] = "No image"
-        self._img = None
+        if self._prefetched is not None:
+            _discard_preview(self._prefetched[1])
+        self._prefetched = None
         self._lbl["image"] = ""
+        self._img_tk = None
 
     def __bool__(self):
         return self.model is not None
@@ -209,6 +482,66 @@ class ImageView(ttk.Frame):
     #     # self._img = self._img_tk.zoom(2)
 
 
+class Store:
+    """Ratings storage, single SQLite file in picture directory.
+
+    Rows are keyed by path relative to directory, without rating in file name.
+    Updates are kept in memory until `commit`.
+
+    Args:
+        pic_dir: Directory with pictures
+    """
+
+    def __init__(self, pic_dir: str):
+        self._pic_dir = pic_dir
+        self._con = sqlite3.connect(os.path.join(pic_dir, DB_NAME))
+        self._con.execute("PRAGMA journal_mode=WAL")
+        # No fsync per commit, still survives app crash (not power loss)
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS rating "
+            "(path TEXT PRIMARY KEY, score REAL NOT NULL, matches INTEGER NOT NULL)"
+        )
+        self._ratings: dict[str, tuple[float, int]] = {
+            path: (score, matches)
+            for path, score, matches in self._con.execute(
+                "SELECT path, score, matches FROM rating"
+            )
+        }
+        self._pending: dict[str, tuple[float, int]] = dict()
+
+    def get(self, fp: str) -> tuple[float, int] | None:
+        """Get score and matches."""
+        return self._ratings.get(os.path.relpath(fp, self._pic_dir))
+
+    def update_pair(self, *players: "RankFileModel"):
+        """Remember ratings after a match."""
+        for p in players:
+            self._pending[os.path.relpath(p.key, self._pic_dir)] = (p.score, p.matches)
+
+    def commit(self):
+        """Write pending updates in a single transaction."""
+        if self._pending:
+            with self._con:
+                self._con.executemany(
+                    "INSERT OR REPLACE INTO rating (path, score, matches) VALUES (?, ?, ?)",
+                    ((path, *rating) for path, rating in self._pending.items()),
+                )
+            self._ratings.update(self._pending)
+            self._pending.clear()
+
+    def clear(self):
+        """Delete all ratings."""
+        with self._con:
+            self._con.execute("DELETE FROM rating")
+        self._ratings.clear()
+        self._pending.clear()
+
+    def close(self):
+        self.commit()
+        self._con.close()
+
+
 class RankFileModel:
     """Image data model (image path, Elo score).
 
@@ -217,6 +550,7 @@ class RankFileModel:
 
     Args:
         fp: File path
+        store: Ratings storage, otherwise rating is parsed from file name only
         score: Default Elo score for new unrated image
         k: Default max gain/loose per match
 
@@ -226,40 +560,76 @@ class RankFileModel:
 
     def __init__(
         self,
-        fp: pathlib.Path,
+        fp: str | os.PathLike,
+        store: Store | None = None,
         score: float = 1400,
         k: float = 32,
     ):
-        self._fp = fp
-        self._fp_clean_name: str = self._fp.name  # File name without leading ratings
+        # Plain strings, as pathlib is slow on renaming
+        self._fp_str = os.fspath(fp)
+        self._parent_str, name = os.path.split(self._fp_str)
+        self._fp_clean_name: str = name  # File name without leading ratings
         self._k = k
         self.matches = 0
+        self._name_cache: str | None = None  # Reset on rating change
 
         # Parse rating from file name
-        if self._fp.stem.startswith("[") and "] " in self._fp.name:
-            ratings, _, self._fp_clean_name = self._fp.name[1:].partition("] ")
+        if name.startswith("[") and "] " in name:
+            ratings, _, self._fp_clean_name = name[1:].partition("] ")
             score, matches = (int(r) for r in ratings.split(","))
             self.matches = matches
 
         self.score = score
 
+        # Storage key, stays the same after `update_name`
+        self.key = os.path.join(self._parent_str, self._fp_clean_name)
+        self._store = store
+        if store is not None and (rating := store.get(self.key)) is not None:
+            self.score, self.matches = rating
+
     def filename(self) -> str:
         """Name with elo score prefix."""
-        return f"[{self.score:04.0f},{self.matches:.0f}] {self._fp_clean_name}"
+        if self._name_cache is None:
+            self._name_cache = (
+                f"[{self.score:04.0f},{self.matches:.0f}] {self._fp_clean_name}"
+            )
+        return self._name_cache
 
     def update_name(self):
         """Rename file according to current rating."""
-        self._fp = self._fp.rename(self._fp.parent / self.filename())
+        self._rename(self.filename())
 
     def reset_name(self):
         """Restore original file name without Elo prefix."""
-        self._fp = self._fp.rename(self._fp.parent / self._fp_clean_name)
+        self._rename(self._fp_clean_name)
+
+    def _rename(self, name: str):
+        """Atomic rename, skipped if rounded rating hasn't changed.
+
+        Never overwrites another file, e.g. "a.jpg" next to "[1500,3] a.jpg".
+        """
+        new = os.path.join(self._parent_str, name)
+        if new == self._fp_str:
+            return
+        if os.path.exists(new):
+            print(f"Not renamed, file already exists: {new}")
+            return
+        os.replace(self._fp_str, new)
+        self._fp_str = new
+
+    @property
+    def fp(self) -> str:
+        """File path as plain string, for hot paths."""
+        return self._fp_str
 
     def get_fp(self) -> pathlib.Path:
-        return self._fp
+        return pathlib.Path(self._fp_str)
 
     def wins_over(self, looser):
-        """Recalculate rationgs and rename both images."""
+        """Recalculate rationgs of both images.
+
+        Files aren't renamed until `update_name` is called.
+        """
         # Current ratings
         R_a = self.score
         R_b = looser.score
@@ -274,8 +644,9 @@ class RankFileModel:
 
         self.matches += 1
         looser.matches += 1
-        self.update_name()
-        looser.update_name()
+        self._name_cache = looser._name_cache = None
+        if self._store is not None:
+            self._store.update_pair(self, looser)
 
 
 def main():